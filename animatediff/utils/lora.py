@@ -658,9 +658,12 @@ def save_lora_safetensors(
     lora_rank="", 
     target_replace_module=DEFAULT_TARGET_REPLACE,
     use_motion_lora_format=False,
-    save_all=False
+    save_all=False,
+    state_dict=None,
+    save_dtype=torch.float32
 ):
-    current_state_dict = model.state_dict()
+    # A precollected state dict avoids walking (and copying) the whole model when only the LoRAs are needed
+    current_state_dict = model.state_dict() if state_dict is None else state_dict
     save_dict = {}
 
     only_save_motion = False
@@ -686,7 +689,7 @@ def save_lora_safetensors(
                     if is_temporal and not only_save_motion:
                         continue
 
-            save_dict[save_key] = v.to('cpu', dtype=torch.float32)
+            save_dict[save_key] = v.to('cpu', dtype=save_dtype)
 
             if verbose:
                 print(target_replace_module, f"Saving: {save_key}")
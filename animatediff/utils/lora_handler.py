@@ -307,7 +307,10 @@ class LoraHandler(object):
         use_safetensors=True, 
         lora_rank="", 
         lora_name="",
-        use_motion_lora_format=False
+        use_motion_lora_format=False,
+        state_dict=None,
+        patch_pipe=True,
+        save_dtype=torch.float32
     ):
         
         # Same arguments as top level method
@@ -320,7 +323,9 @@ class LoraHandler(object):
             save_path, 
             use_safetensors=True, 
             lora_rank="",
-            use_motion_lora_format=False
+            use_motion_lora_format=False,
+            state_dict=None,
+            save_dtype=torch.float32
         ): 
             if condition and replace_modules is not None:
                 
@@ -340,7 +345,9 @@ class LoraHandler(object):
                         save_path + ".safetensors", 
                         target_replace_module=replace_modules,
                         lora_rank=lora_rank,
-                        use_motion_lora_format=use_motion_lora_format
+                        use_motion_lora_format=use_motion_lora_format,
+                        state_dict=state_dict,
+                        save_dtype=save_dtype
                     )
 
         save_lora(
@@ -352,7 +359,9 @@ class LoraHandler(object):
             save_path, 
             use_safetensors,
             lora_rank,
-            use_motion_lora_format
+            use_motion_lora_format,
+            state_dict,
+            save_dtype
         )
         save_lora(
             model.text_encoder, 
@@ -363,10 +372,13 @@ class LoraHandler(object):
             save_path,
             use_safetensors,
             lora_rank,
-            use_motion_lora_format
+            use_motion_lora_format,
+            save_dtype=save_dtype
         )
 
-        train_patch_pipe(model, self.use_unet_lora, self.use_text_lora)
+        # Patching collapses the LoRAs into the model, so it's skipped when saving from a model that is still being trained
+        if patch_pipe:
+            train_patch_pipe(model, self.use_unet_lora, self.use_text_lora)
 
     def save_stable_lora(
         self, 
@@ -406,7 +418,10 @@ class LoraHandler(object):
         use_safetensors: bool = True,
         lora_rank="Not Logged",
         lora_name="",
-        use_motion_lora_format=False
+        use_motion_lora_format=False,
+        state_dict=None,
+        patch_pipe=True,
+        save_dtype=torch.float32
     ):
         save_path = f"{save_path}"
         os.makedirs(save_path, exist_ok=True)
@@ -426,7 +441,10 @@ class LoraHandler(object):
                 use_safetensors=use_safetensors, 
                 lora_rank=lora_rank,
                 lora_name=lora_name,
-                use_motion_lora_format=use_motion_lora_format
+                use_motion_lora_format=use_motion_lora_format,
+                state_dict=state_dict,
+                patch_pipe=patch_pipe,
+                save_dtype=save_dtype
             )
 
         if self.is_stable_lora():
@@ -1,12 +1,13 @@
 import os
 import math
+import functools
 import random
 import logging
 import datetime
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
-from einops import rearrange
 from omegaconf import OmegaConf
 
 import torch
@@ -38,10 +39,95 @@ try:
 except:
     XFORMERS_IS_AVAILABLE = False
 
+try:
+    import triton
+
+    TRITON_IS_AVAILABLE = True
+except:
+    TRITON_IS_AVAILABLE = False
+
 script_directory = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger(__name__)
+# Sanity check videos are encoded in the background so writing them doesn't hold up the node
+video_save_executor = ThreadPoolExecutor(max_workers=1)
 folder_paths.add_model_folder_path("animatediff_models", str(Path(__file__).parent.parent / "models"))
 folder_paths.add_model_folder_path("animatediff_models", str(Path(folder_paths.models_dir) / "animatediff_models"))
 
+# Make one log on every process with the configuration for debugging.
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+# The configs are static, so they are only read once on import
+training_config = OmegaConf.load(os.path.join(script_directory, "configs/training/motion_director/training.yaml"))
+original_config = OmegaConf.load(os.path.join(script_directory, "configs/v1-inference.yaml"))
+ad_unet_config = OmegaConf.load(os.path.join(script_directory, "configs/ad_unet_config.yaml"))
+
+noise_scheduler_kwargs = {
+    'num_train_timesteps': 1000,
+    'beta_start':    0.00085,
+    'beta_end':      0.012,
+    'beta_schedule': "linear",
+    'clip_sample':   False,
+    'steps_offset': 1
+}
+
+@functools.lru_cache(maxsize=None)
+def create_noise_schedulers(scheduler: str):
+    # Determine the scheduler class based on the scheduler variable
+    SchedulerClass = DDPMScheduler if scheduler == "DDPMScheduler" else DDIMScheduler
+
+    # The default noise scheduler and the linear training scheduler use the linear beta_schedule,
+    # the spatial training scheduler uses scaled_linear
+    noise_scheduler = SchedulerClass(**{**noise_scheduler_kwargs, 'beta_schedule': 'linear'})
+    train_noise_scheduler_spatial = SchedulerClass(**{**noise_scheduler_kwargs, 'beta_schedule': 'scaled_linear'})
+    train_noise_scheduler = SchedulerClass(**{**noise_scheduler_kwargs, 'beta_schedule': 'linear'})
+
+    return noise_scheduler, train_noise_scheduler_spatial, train_noise_scheduler
+
+# search paths -> (mtime of every folder the walk listed, model paths found)
+diffusers_models_cache = {}
+
+def get_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def find_diffusers_models(search_paths: tuple):
+    # Adding or removing an entry changes the mtime of its parent folder, so the walk is only redone when one of the
+    # folders it listed has changed. That includes nested folders like diffusers/<org>/<model>
+    cached = diffusers_models_cache.get(search_paths)
+    if cached is not None and all(get_mtime_ns(path) == mtime for path, mtime in cached[0].items()):
+        return list(cached[1])
+
+    folder_mtimes = {}
+    paths = []
+    for search_path in search_paths:
+        folder_mtimes[search_path] = get_mtime_ns(search_path)
+        if os.path.exists(search_path):
+            for root, subdir, files in os.walk(search_path, followlinks=True):
+                if "model_index.json" in files:
+                    paths.append(os.path.relpath(root, start=search_path))
+                    # Don't descend into the model's own subfolders
+                    subdir[:] = []
+                else:
+                    folder_mtimes[root] = get_mtime_ns(root)
+    diffusers_models_cache[search_paths] = (folder_mtimes, paths)
+    return list(paths)
+
+class ComfyProgressTqdm(tqdm):
+    # tqdm that also reports its progress to the ComfyUI progress bar
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.comfy_pbar = comfy.utils.ProgressBar(self.total or 1)
+
+    def update(self, n=1):
+        super().update(n)
+        self.comfy_pbar.update(n)
+
 def create_save_paths(output_dir: str):
     directories = [
         output_dir,
@@ -103,24 +189,47 @@ def do_sanity_check(
     
 
     sanity_check, texts = sanity_check.cpu(), text_prompt  
-    sanity_check = rearrange(sanity_check, "b f c h w -> b c f h w")
-    for idx, (pixel_value, text) in enumerate(zip(sanity_check, texts)):
+    sanity_check = sanity_check.movedim(1, 2) # b f c h w -> b c f h w
+    save_names = [
+        f"{'-'.join(text.replace('/', '').split()[:10]) if not text == '' else f'-{idx}'}.mp4" 
+        for idx, text in enumerate(texts)
+    ]
+    for pixel_value, save_name in zip(sanity_check, save_names):
         pixel_value = pixel_value[None, ...]
-        text = text
-        save_name = f"{'-'.join(text.replace('/', '').split()[:10]) if not text == '' else f'-{idx}'}.mp4"
-        save_videos_grid(pixel_value, f"{output_dir}/sanity_check/{save_name}", rescale=False)
+        future = video_save_executor.submit(save_videos_grid, pixel_value, f"{output_dir}/sanity_check/{save_name}", rescale=False)
+        future.add_done_callback(log_save_error)
     return(sanity_check)
 
-def sample_noise(latents, noise_strength, use_offset_noise=False):
-    b, c, f, *_ = latents.shape
-    noise_latents = torch.randn_like(latents, device=latents.device)
+def log_save_error(future):
+    if future.exception() is not None:
+        logger.error(f"Failed to save sanity check video: {future.exception()}")
+
+@torch.jit.script
+def sample_noise(latents: torch.Tensor, noise_strength: float, use_offset_noise: bool = False) -> torch.Tensor:
+    b, c, f = latents.shape[0], latents.shape[1], latents.shape[2]
+    noise_latents = torch.randn(latents.shape, device=latents.device, dtype=latents.dtype)
 
     if use_offset_noise:
-        offset_noise = torch.randn(b, c, f, 1, 1, device=latents.device)
-        noise_latents = noise_latents + noise_strength * offset_noise
+        offset_noise = torch.randn([b, c, f, 1, 1], device=latents.device, dtype=latents.dtype)
+        noise_latents.add_(offset_noise, alpha=noise_strength)
 
     return noise_latents
 
+@torch.jit.script
+def add_noise(
+        alphas_cumprod: torch.Tensor, 
+        latents: torch.Tensor, 
+        noise: torch.Tensor, 
+        timesteps: torch.Tensor
+    ) -> torch.Tensor:
+    # Same as the diffusers schedulers' add_noise, with alphas_cumprod already on the latents' device
+    alphas_cumprod = alphas_cumprod[timesteps].to(latents.dtype)
+    shape = [-1] + [1] * (latents.dim() - 1)
+    sqrt_alpha_prod = alphas_cumprod.sqrt().view(shape)
+    sqrt_one_minus_alpha_prod = (1 - alphas_cumprod).sqrt().view(shape)
+
+    return sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * noise
+
 def param_optim(model, condition, extra_params=None, is_lora=False, negation=None):
     extra_params = extra_params if len(extra_params.keys()) > 0 else None
     return {
@@ -158,21 +267,26 @@ def create_optimizer_params(model_list, lr):
             optimizer_params.append(params)
             continue
 
+        # All parameters share the same lr and extra params, so they go into a single group
+        # instead of one group per parameter.
         if is_lora and condition and not isinstance(model, list):
-            for n, p in model.named_parameters():
-                if 'lora' in n:
-                    params = create_optim_params(n, p, lr, extra_params)
-                    optimizer_params.append(params)
+            params = create_optim_params(
+                'lora', 
+                [p for n, p in model.named_parameters() if 'lora' in n], 
+                lr, 
+                extra_params
+            )
+            optimizer_params.append(params)
             continue
 
         # If this is true, we can train it.
         if condition:
-            for n, p in model.named_parameters():
-                should_negate = 'lora' in n and not is_lora
-                if should_negate: continue
-            
-                params = create_optim_params(n, p, lr, extra_params)
-                optimizer_params.append(params)
+            params = create_optim_params(
+                params=[p for n, p in model.named_parameters() if not ('lora' in n and not is_lora)], 
+                lr=lr, 
+                extra_params=extra_params
+            )
+            optimizer_params.append(params)
 
     return optimizer_params
 
@@ -190,10 +304,10 @@ def scale_loras(lora_list: list, scale: float, step=None):
             lora_i.scale = scale
 
 def tensor_to_vae_latent(t, vae):
-    video_length = t.shape[1]
-    t = rearrange(t, "b f c h w -> (b f) c h w") 
+    b, f = t.shape[:2]
+    t = t.flatten(0, 1) # b f c h w -> (b f) c h w
     latents = vae.encode(t).latent_dist.sample()
-    latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
+    latents = latents.unflatten(0, (b, f)).movedim(1, 2) # (b f) c h w -> b c f h w
     latents = latents * 0.18215
 
     return latents
@@ -213,25 +327,68 @@ def get_spatial_latents(
 
     return noisy_latents_input, target_spatial
 
+@torch.jit.script
 def create_ad_temporal_loss(
         model_pred: torch.Tensor, 
         loss_temporal: torch.Tensor, 
         target: torch.Tensor
-    ):
+    ) -> torch.Tensor:
 
-    beta = 1
+    beta = 1.0
     alpha = (beta ** 2 + 1) ** 0.5
 
-    ran_idx = torch.randint(0, model_pred.shape[2], (1,)).item()
+    ran_idx = int(torch.randint(0, model_pred.shape[2], [1]).item())
 
-    model_pred_decent = alpha * model_pred - beta * model_pred[:, :, ran_idx, :, :].unsqueeze(2)
-    target_decent = alpha * target - beta * target[:, :, ran_idx, :, :].unsqueeze(2)
+    # Same as the mse between the decentered prediction and target, without materializing both
+    diff = model_pred.float() - target.float()
+    diff_decent = alpha * diff - beta * diff[:, :, ran_idx:ran_idx + 1, :, :]
 
-    loss_ad_temporal = F.mse_loss(model_pred_decent.float(), target_decent.float(), reduction="mean")
+    loss_ad_temporal = diff_decent.pow(2).mean()
     loss_temporal = loss_temporal + loss_ad_temporal
 
     return loss_temporal
 
+def collect_lora_state_dict(unet):
+    return {
+        n: p.detach() for n, p in unet.named_parameters()
+        if 'lora_up' in n or 'lora_down' in n
+    }
+
+def get_autocast_dtype():
+    # bf16 has the fp32 range and runs at full speed on Ampere and newer, so no loss scaling is needed there
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+class CompiledUnet:
+    """
+    Calls the compiled unet and switches to the eager one for good if compiling or running it fails.
+    """
+    def __init__(self, unet, compiled_unet):
+        self.unet = unet
+        self.compiled_unet = compiled_unet
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled_unet is not None:
+            try:
+                return self.compiled_unet(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"torch.compile failed, running the unet eagerly: {e}")
+                self.compiled_unet = None
+        return self.unet(*args, **kwargs)
+
+def compile_unet(unet):
+    # Opt in with ADMD_COMPILE=1. Every new input shape and LoRA scale combination compiles again,
+    # which can take minutes in the middle of training. Inductor needs triton for GPU kernels
+    if os.environ.get("ADMD_COMPILE", "0") != "1" or not hasattr(torch, "compile") or not TRITON_IS_AVAILABLE:
+        return unet
+
+    unet.to(memory_format=torch.channels_last)
+    # The inductor settings are passed to this compile only, so other nodes using torch.compile aren't affected.
+    # triton.cudagraphs is what mode="reduce-overhead" enables, mode and options can't be combined
+    compiled_unet = torch.compile(unet, dynamic=False, options={"triton.cudagraphs": True, "conv_1x1_as_mm": True})
+    return CompiledUnet(unet, compiled_unet)
+
 class ADMD_InitializeTraining:
     @classmethod
     def INPUT_TYPES(s):
@@ -255,7 +412,6 @@ class ADMD_InitializeTraining:
             }),
             "include_resnet": ("BOOLEAN", {"default": False}),
             },
-            
             }
     
     RETURN_TYPES = ("IMAGE", "ADMDPIPELINE", "LORAINFO")
@@ -282,6 +438,17 @@ class ADMD_InitializeTraining:
 
             text_prompt = []
             text_prompt.append(prompt)
+
+            # Tokenize once here, pinned so the training node can copy the ids to the gpu asynchronously
+            prompt_ids = tokenizer(
+                text_prompt, 
+                max_length=tokenizer.model_max_length, 
+                padding="max_length", 
+                truncation=True, 
+                return_tensors="pt"
+            ).input_ids
+            if torch.cuda.is_available():
+                prompt_ids = prompt_ids.pin_memory()
   
             scale_lr = False
             lr_warmup_steps = 0
@@ -313,13 +480,6 @@ class ADMD_InitializeTraining:
             if is_debug and os.path.exists(output_dir):
                 os.system(f"rm -rf {output_dir}")
 
-            # Make one log on every process with the configuration for debugging.
-            logging.basicConfig(
-                format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-                datefmt="%m/%d/%Y %H:%M:%S",
-                level=logging.INFO,
-            )
-
             # set paths
             spatial_lora_path = os.path.join(folder_paths.models_dir,"loras", "trained_spatial", date_calendar, date_time, lora_name) 
             temporal_lora_path = os.path.join(folder_paths.models_dir,"animatediff_motion_lora", date_calendar, date_time, lora_name)
@@ -402,10 +562,20 @@ class ADMD_InitializeTraining:
                 num_training_steps=max_train_steps * gradient_accumulation_steps,
             )
             lr_scheduler_spatial_list.append(lr_scheduler_spatial)
+
+            # The injected LoRA modules don't change, so they are looked up once for training and validation.
+            # Validation only scales the transformer LoRAs, the spatial list also has the resnet ones if included.
+            transformer_loras = extract_lora_child_module(unet, target_replace_module=["Transformer3DModel"])
+            if include_resnet:
+                spatial_loras = transformer_loras + extract_lora_child_module(unet, target_replace_module=["ResnetBlock2D"])
+            else:
+                spatial_loras = transformer_loras
+            temporal_loras = extract_lora_child_module(unet, target_replace_module=target_temporal_modules)
            
-            # Support mixed-precision training
+            # Support mixed-precision training, the scaler is only enabled for fp16 and otherwise passes through
+            autocast_dtype = get_autocast_dtype()
             if 'scaler' not in globals():
-                scaler = torch.cuda.amp.GradScaler()
+                scaler = torch.cuda.amp.GradScaler(enabled=autocast_dtype == torch.float16)
                 print("initialize scaler")
             else:
                 scaler.reset()
@@ -417,6 +587,7 @@ class ADMD_InitializeTraining:
             "lr_scheduler_spatial_list": lr_scheduler_spatial_list,
             "lr_scheduler_temporal": lr_scheduler_temporal,
             "text_prompt": text_prompt,
+            "prompt_ids": prompt_ids,
             "unet": unet,
             "text_encoder": text_encoder,
             "vae": vae,
@@ -428,6 +599,10 @@ class ADMD_InitializeTraining:
             "global_step": 0,
             "max_train_steps": max_train_steps,
             "scaler": scaler,
+            "autocast_dtype": autocast_dtype,
+            "spatial_loras": spatial_loras,
+            "temporal_loras": temporal_loras,
+            "transformer_loras": transformer_loras,
             "include_resnet": include_resnet,
             "seed": seed
         }
@@ -450,12 +625,7 @@ class ADMD_DiffusersLoader:
         return ""
     @classmethod
     def INPUT_TYPES(cls):
-        paths = []
-        for search_path in folder_paths.get_folder_paths("diffusers"):
-            if os.path.exists(search_path):
-                for root, subdir, files in os.walk(search_path, followlinks=True):
-                    if "model_index.json" in files:
-                        paths.append(os.path.relpath(root, start=search_path))
+        paths = find_diffusers_models(tuple(folder_paths.get_folder_paths("diffusers")))
 
         return {"required":
                 {
@@ -483,60 +653,34 @@ class ADMD_DiffusersLoader:
 
     def load_checkpoint(self, download_default, scheduler, use_xformers, additional_models, model=""):
         with torch.inference_mode(False):
-            device = comfy.model_management.get_torch_device()
             target_path = os.path.join(folder_paths.models_dir,'diffusers', "stable-diffusion-v1-5")      
             if download_default and model != os.path.exists(target_path):
                 from huggingface_hub import snapshot_download
                 download_to = os.path.join(folder_paths.models_dir,'diffusers')
+                # Mirror the download progress to the ComfyUI progress bar
                 snapshot_download(repo_id="runwayml/stable-diffusion-v1-5", ignore_patterns=["*.safetensors","*.ckpt", "*.pt", "*.png", "*non_ema*", "*safety_checker*", "*fp16*"], 
-                                    local_dir=f"{download_to}/stable-diffusion-v1-5", local_dir_use_symlinks=False)   
+                                    local_dir=f"{download_to}/stable-diffusion-v1-5", local_dir_use_symlinks=False, 
+                                    tqdm_class=ComfyProgressTqdm)   
                 model_path = "stable-diffusion-v1-5"
             else:
                 model_path = model
             
-            for search_path in folder_paths.get_folder_paths("diffusers"):
-                if os.path.exists(search_path):
-                    path = os.path.join(search_path, model_path)
-                    if os.path.exists(path):
-                        model_path = path
-                        break      
+            # First diffusers folder that holds the model wins, one stat per candidate
+            candidates = (os.path.join(search_path, model_path) for search_path in folder_paths.get_folder_paths("diffusers"))
+            model_path = next((path for path in candidates if os.path.isdir(path)), model_path)
             
-            config = OmegaConf.load(os.path.join(script_directory, f"configs/training/motion_director/training.yaml"))
-       
+            # The models are loaded one at a time: low memory loading patches module construction process-wide,
+            # which would leave parameters of a model built on another thread on the meta device
             vae          = AutoencoderKL.from_pretrained(model_path, subfolder="vae")
             tokenizer    = CLIPTokenizer.from_pretrained(model_path, subfolder="tokenizer")
             text_encoder = CLIPTextModel.from_pretrained(model_path, subfolder="text_encoder")
-         
-            unet_additional_kwargs = config.unet_additional_kwargs
-            unet = UNet3DConditionModel.from_pretrained_2d(
+            unet         = UNet3DConditionModel.from_pretrained_2d(
                 model_path, subfolder="unet", 
-                unet_additional_kwargs=unet_additional_kwargs
+                unet_additional_kwargs=training_config.unet_additional_kwargs
             )
             
-            # Load scheduler, tokenizer and models.
-            noise_scheduler_kwargs = {
-                'num_train_timesteps': 1000,
-                'beta_start':    0.00085,
-                'beta_end':      0.012,
-                'beta_schedule': "linear",
-                'clip_sample':   False,
-                'steps_offset': 1
-            }
-            # Determine the scheduler class based on the scheduler variable
-            SchedulerClass = DDPMScheduler if scheduler == "DDPMScheduler" else DDIMScheduler
-            print(f"using {SchedulerClass.__name__} for training")
-
-            # Set the beta_schedule and create the default noise scheduler
-            noise_scheduler_kwargs['beta_schedule'] = 'linear'
-            noise_scheduler = SchedulerClass(**noise_scheduler_kwargs)
-
-            # Set the beta_schedule for the spatial noise scheduler and create it
-            noise_scheduler_kwargs['beta_schedule'] = 'scaled_linear'
-            train_noise_scheduler_spatial = SchedulerClass(**noise_scheduler_kwargs)
-
-            # Reset the beta_schedule for the linear noise scheduler and create it
-            noise_scheduler_kwargs['beta_schedule'] = 'linear'
-            train_noise_scheduler = SchedulerClass(**noise_scheduler_kwargs)
+            noise_scheduler, train_noise_scheduler_spatial, train_noise_scheduler = create_noise_schedulers(scheduler)
+            print(f"using {type(train_noise_scheduler).__name__} for training")
             
             # Freeze all models for LoRA training
             unet.requires_grad_(False)
@@ -556,7 +700,7 @@ class ADMD_DiffusersLoader:
             # Validation pipeline
             validation_pipeline = AnimationPipeline(
                 unet=unet, vae=vae, tokenizer=tokenizer, text_encoder=text_encoder, scheduler=noise_scheduler,
-            ).to(device)
+            )
 
             motion_model, domain_adapter_path = additional_models 
 
@@ -611,8 +755,6 @@ class ADMD_CheckpointLoader:
     def load_checkpoint(self, scheduler, use_xformers, additional_models, ckpt_name):
         with torch.inference_mode(False):            
             model_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-            original_config = OmegaConf.load(os.path.join(script_directory, f"configs/v1-inference.yaml"))
-            ad_unet_config = OmegaConf.load(os.path.join(script_directory, f"configs/ad_unet_config.yaml"))
 
             from .single_file_utils import (convert_ldm_vae_checkpoint, convert_ldm_unet_checkpoint, create_text_encoder_from_ldm_clip_checkpoint, create_vae_diffusers_config, create_unet_diffusers_config)
             from safetensors import safe_open
@@ -630,29 +772,8 @@ class ADMD_CheckpointLoader:
             tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
             text_encoder = create_text_encoder_from_ldm_clip_checkpoint("openai/clip-vit-large-patch14",dreambooth_state_dict)
 
-            noise_scheduler_kwargs = {
-                'num_train_timesteps': 1000,
-                'beta_start':    0.00085,
-                'beta_end':      0.012,
-                'beta_schedule': "linear",
-                'clip_sample':   False,
-                'steps_offset': 1
-            }
-            #Determine the scheduler class based on the scheduler variable
-            SchedulerClass = DDPMScheduler if scheduler == "DDPMScheduler" else DDIMScheduler
-            print(f"using {SchedulerClass.__name__} for training")
-
-            # Set the beta_schedule and create the default noise scheduler
-            noise_scheduler_kwargs['beta_schedule'] = 'linear'
-            noise_scheduler = SchedulerClass(**noise_scheduler_kwargs)
-
-            # Set the beta_schedule for the spatial noise scheduler and create it
-            noise_scheduler_kwargs['beta_schedule'] = 'scaled_linear'
-            train_noise_scheduler_spatial = SchedulerClass(**noise_scheduler_kwargs)
-
-            # Reset the beta_schedule for the linear noise scheduler and create it
-            noise_scheduler_kwargs['beta_schedule'] = 'linear'
-            train_noise_scheduler = SchedulerClass(**noise_scheduler_kwargs)
+            noise_scheduler, train_noise_scheduler_spatial, train_noise_scheduler = create_noise_schedulers(scheduler)
+            print(f"using {type(train_noise_scheduler).__name__} for training")
 
             # 1. vae
             converted_vae_config = create_vae_diffusers_config(original_config, image_size=512)
@@ -743,8 +864,6 @@ class ADMD_ComfyModelLoader:
         with torch.inference_mode(False):
         
             pbar = comfy.utils.ProgressBar(4)
-            original_config = OmegaConf.load(os.path.join(script_directory, f"configs/v1-inference.yaml"))
-            ad_unet_config = OmegaConf.load(os.path.join(script_directory, f"configs/ad_unet_config.yaml"))
 
             from .single_file_utils import (convert_ldm_vae_checkpoint, convert_ldm_unet_checkpoint, create_text_encoder_from_ldm_clip_checkpoint, create_vae_diffusers_config, create_unet_diffusers_config)
 
@@ -760,29 +879,8 @@ class ADMD_ComfyModelLoader:
      
             text_encoder = create_text_encoder_from_ldm_clip_checkpoint("openai/clip-vit-large-patch14",sd)
             pbar.update(1)
-            noise_scheduler_kwargs = {
-                'num_train_timesteps': 1000,
-                'beta_start':    0.00085,
-                'beta_end':      0.012,
-                'beta_schedule': "linear",
-                'clip_sample':   False,
-                'steps_offset': 1
-            }
-            #Determine the scheduler class based on the scheduler variable
-            SchedulerClass = DDPMScheduler if scheduler == "DDPMScheduler" else DDIMScheduler
-            print(f"using {SchedulerClass.__name__} for training")
-
-            # Set the beta_schedule and create the default noise scheduler
-            noise_scheduler_kwargs['beta_schedule'] = 'linear'
-            noise_scheduler = SchedulerClass(**noise_scheduler_kwargs)
-
-            # Set the beta_schedule for the spatial noise scheduler and create it
-            noise_scheduler_kwargs['beta_schedule'] = 'scaled_linear'
-            train_noise_scheduler_spatial = SchedulerClass(**noise_scheduler_kwargs)
-
-            # Reset the beta_schedule for the linear noise scheduler and create it
-            noise_scheduler_kwargs['beta_schedule'] = 'linear'
-            train_noise_scheduler = SchedulerClass(**noise_scheduler_kwargs)
+            noise_scheduler, train_noise_scheduler_spatial, train_noise_scheduler = create_noise_schedulers(scheduler)
+            print(f"using {type(train_noise_scheduler).__name__} for training")
 
             # 1. vae
             converted_vae_config = create_vae_diffusers_config(original_config, image_size=512)
@@ -887,7 +985,9 @@ class ADMD_ValidationSettings:
         "spatial_scale": ("FLOAT", {"default": 0.5, "min": 0, "max": 1, "step": 0.01}),                                        
         "validation_prompt": ("STRING", {"multiline": True, "default": "",}),
         },
-          
+            "optional": {
+        "prompt_separator": ("STRING", {"multiline": False, "default": "",}),
+        },
         }
     RETURN_TYPES = ("VALIDATION_SETTINGS",)
     RETURN_NAMES = ("validation_settings",)
@@ -895,7 +995,7 @@ class ADMD_ValidationSettings:
 
     CATEGORY = "AD_MotionDirector"
 
-    def create_validation_settings(self, inference_steps, guidance_scale, spatial_scale, seed, validation_prompt):
+    def create_validation_settings(self, inference_steps, guidance_scale, spatial_scale, seed, validation_prompt, prompt_separator=""):
         # Create a dictionary with the local variables
         local_vars = locals()
         
@@ -905,7 +1005,8 @@ class ADMD_ValidationSettings:
             "guidance_scale": local_vars["guidance_scale"],
             "spatial_scale": local_vars["spatial_scale"],
             "seed": local_vars["seed"],
-            "validation_prompt": local_vars["validation_prompt"]
+            "validation_prompt": local_vars["validation_prompt"],
+            "prompt_separator": local_vars["prompt_separator"]
         }
        
         return validation_settings,
@@ -952,6 +1053,9 @@ class ADMD_SaveLora:
                 "admd_pipeline": ("ADMDPIPELINE", ),
                 "lora_info": ("LORAINFO", ),
             },
+            "optional": {
+                "save_dtype": (["fp32", "fp16", "bf16"], {"default": "fp32"}),
+            },
         }
     
     RETURN_TYPES = ("STRING", "ADMDPIPELINE",)
@@ -959,13 +1063,15 @@ class ADMD_SaveLora:
     CATEGORY = "AD_MotionDirector"
     FUNCTION = "save_motion_lora"
 
-    def save_motion_lora(self, admd_pipeline, lora_info):
+    def save_motion_lora(self, admd_pipeline, lora_info, save_dtype="fp32"):
+        dtype_map = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
         with torch.inference_mode(False):
             validation_pipeline = admd_pipeline['validation_pipeline']
             global_step = admd_pipeline['global_step']
 
-            import copy
-            validation_pipeline.to('cpu')  # We do this to prevent VRAM spiking / increase from the new copy
+            # Only the LoRA weights are saved, so read them straight from the trained unet instead of
+            # saving from a deepcopy of the whole pipeline
+            lora_state_dict = collect_lora_state_dict(validation_pipeline.unet)
             
             spatial_lora_path = lora_info['spatial_lora_path']
             temporal_lora_path = lora_info['temporal_lora_path']
@@ -975,25 +1081,36 @@ class ADMD_SaveLora:
 
             lora_manager_spatial = LoraHandler(use_unet_lora=True, unet_replace_modules=["Transformer3DModel"])
             lora_manager_spatial.save_lora_weights(
-                model=copy.deepcopy(validation_pipeline), 
+                model=validation_pipeline, 
                 save_path=spatial_lora_path, 
                 step=global_step,
                 use_safetensors=True,
                 lora_rank=lora_rank,
                 lora_name=lora_name + "_r"+ str(lora_rank) + "_spatial",
+                state_dict=lora_state_dict,
+                patch_pipe=False,
+                save_dtype=dtype_map[save_dtype]
             )
             lora_manager_temporal = LoraHandler(use_unet_lora=True, unet_replace_modules=["TemporalTransformerBlock"])
             if lora_manager_temporal is not None:
                 lora_manager_temporal.save_lora_weights(
-                    model=copy.deepcopy(validation_pipeline), 
+                    model=validation_pipeline, 
                     save_path=temporal_lora_path, 
                     step=global_step,
                     use_safetensors=True,
                     lora_rank=lora_rank,
                     lora_name=lora_name + "_r"+ str(lora_rank) + "_temporal",
-                    use_motion_lora_format=True
+                    use_motion_lora_format=True,
+                    state_dict=lora_state_dict,
+                    patch_pipe=False,
+                    save_dtype=dtype_map[save_dtype]
                 )
 
+            # ComfyUI's model management doesn't track these modules, so free the VRAM for the nodes that follow.
+            # Training moves the unet back to the device on its next call
+            validation_pipeline.to('cpu')
+            comfy.model_management.soft_empty_cache()
+
             final_temporal_lora_name = os.path.join(temporal_lora_base_path, (str(global_step) + "_" + lora_name + "_r"+ str(lora_rank) + "_temporal_unet.safetensors"))
        
             return (final_temporal_lora_name, admd_pipeline)
@@ -1024,7 +1141,6 @@ class ADMD_TrainLora:
             train_noise_scheduler_spatial = admd_pipeline["train_noise_scheduler_spatial"]
             
             text_encoder = admd_pipeline["text_encoder"]
-            tokenizer = admd_pipeline["tokenizer"]
             
             optimizer_temporal = admd_pipeline["optimizer_temporal"]
             optimizer_spatial_list = admd_pipeline["optimizer_spatial_list"]
@@ -1033,8 +1149,8 @@ class ADMD_TrainLora:
             text_prompt = admd_pipeline["text_prompt"]
             pixel_values = admd_pipeline["pixel_values"]
             scaler = admd_pipeline["scaler"]
+            autocast_dtype = admd_pipeline["autocast_dtype"]
             seed = admd_pipeline["seed"]
-            include_resnet = admd_pipeline["include_resnet"]
             use_offset_noise = False
 
             torch.manual_seed(seed)
@@ -1046,38 +1162,34 @@ class ADMD_TrainLora:
             vae = admd_pipeline["vae"]
 
             unet.to(device)
-            vae.to(device)
-            text_encoder.to(device)
-            unet.enable_gradient_checkpointing()
             unet.train()
 
-            if include_resnet:
-                target_spatial_modules = ["Transformer3DModel", "ResnetBlock2D"]
-            else: 
-                target_spatial_modules = ["Transformer3DModel"]
+            # Compile once per training run, after LoRA injection so the graph includes the LoRA modules
+            train_unet = admd_pipeline.get("compiled_unet")
+            if train_unet is None:
+                train_unet = compile_unet(unet)
+                admd_pipeline["compiled_unet"] = train_unet
 
-            target_temporal_modules = ["TemporalTransformerBlock"]
-      
             first_epoch = 0
             gradient_accumulation_steps = 1
             global_step = admd_pipeline["global_step"]
-            print(f"global_step: {global_step}")
+            logger.info(f"global_step: {global_step}")
             
             
-            # Get the text embedding for conditioning
+            # Get the text embedding for conditioning, the prompt is fixed so it's only encoded once per training run
             with torch.no_grad():
-                prompt_ids = tokenizer(
-                    text_prompt, 
-                    max_length=tokenizer.model_max_length, 
-                    padding="max_length", 
-                    truncation=True, 
-                    return_tensors="pt"
-                ).input_ids.to(device)
-
-                #text encoding
-                text_encoder.to(device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]
-                text_encoder.to('cpu')
+                encoder_hidden_states = admd_pipeline.get("encoder_hidden_states")
+                if encoder_hidden_states is None:
+                    prompt_ids = admd_pipeline["prompt_ids"].to(device, non_blocking=True)
+
+                    #text encoding
+                    text_encoder.to(device)
+                    encoder_hidden_states = text_encoder(prompt_ids)[0]
+                    admd_pipeline["encoder_hidden_states"] = encoder_hidden_states
+
+                # The training images are static, so their latents are cached unless they are overridden.
+                # Only the latents live on the device, the pixel values are just kept for their shape.
+                cached_latents = admd_pipeline.get("cached_latents") if opt_images_override is None else None
 
                 pixel_list = []
                 latent_list = []
@@ -1085,30 +1197,41 @@ class ADMD_TrainLora:
                 if opt_images_override is not None:
                     pixel_values = opt_images_override
 
-                if isinstance(pixel_values, list):
-                    print(f"Received {len(pixel_values)} batches:")
+                if cached_latents is not None:
+                    pixel_list, latent_list = cached_latents
+                    batch_size = len(latent_list)
+                    logger.info("Using cached latents")
+                elif isinstance(pixel_values, list):
+                    vae.to(device)
+                    logger.info(f"Received {len(pixel_values)} batches:")
                     for p in pixel_values:
-                        print("input batch shape:", p.shape)
+                        logger.info(f"input batch shape: {p.shape}")
                         p = p * 2.0 - 1.0 #normalize to the expected range (-1, 1)
                         p = p.permute(0, 3, 1, 2).unsqueeze(0)#B,H,W,C to B,F,C,H,W
-                        p = p.to(device)
                         pixel_list.append(p)
-                        latent_list.append(tensor_to_vae_latent(p, vae))
+                        latent_list.append(tensor_to_vae_latent(p.to(device, non_blocking=True), vae))
                         batch_size = len(pixel_list)
                 else:
-                    print("Received a single batch")
-                    print("input batch shape:", pixel_values.shape)
+                    vae.to(device)
+                    logger.info("Received a single batch")
+                    logger.info(f"input batch shape: {pixel_values.shape}")
                     pixel_values = pixel_values * 2.0 - 1.0 #normalize to the expected range (-1, 1)
                     pixel_values = pixel_values.permute(0, 3, 1, 2).unsqueeze(0)#B,H,W,C to B,F,C,H,W
-                    pixel_values = pixel_values.to(device)
-                    latents = tensor_to_vae_latent(pixel_values, vae)
+                    latents = tensor_to_vae_latent(pixel_values.to(device, non_blocking=True), vae)
                     pixel_list.append(pixel_values)
                     latent_list.append(latents)
                     batch_size = 1
 
                 
-                print("batch_size:", batch_size)
+                logger.info(f"batch_size: {batch_size}")
+
+                # The vae and text encoder are shared with the validation pipeline, which moves them to the device,
+                # so they're offloaded on every call to keep them out of VRAM while training
                 vae.to('cpu')
+                text_encoder.to('cpu')
+
+                if opt_images_override is None:
+                    admd_pipeline["cached_latents"] = (pixel_list, latent_list)
 
                 #num_update_steps_per_epoch = math.ceil(batch_size) / gradient_accumulation_steps
                 #num_train_epochs = math.ceil(max_train_steps / num_update_steps_per_epoch)
@@ -1117,6 +1240,17 @@ class ADMD_TrainLora:
                 progress_bar.set_description("Steps")
                 pbar = comfy.utils.ProgressBar(steps)
 
+            spatial_loras = admd_pipeline["spatial_loras"]
+            temporal_loras = admd_pipeline["temporal_loras"]
+            alphas_cumprod = train_noise_scheduler.alphas_cumprod.to(device)
+            alphas_cumprod_spatial = train_noise_scheduler_spatial.alphas_cumprod.to(device)
+
+            temporal_params = [p for group in optimizer_temporal.param_groups for p in group["params"]]
+            spatial_params = [
+                p for optimizer in optimizer_spatial_list for group in optimizer.param_groups for p in group["params"]
+            ]
+            trainable_params = spatial_params + temporal_params
+
             import itertools
             pixel_cycle = itertools.cycle(pixel_list)
             latent_cycle = itertools.cycle(latent_list)
@@ -1128,70 +1262,66 @@ class ADMD_TrainLora:
                 spatial_scheduler_lr = 0.0
                 temporal_scheduler_lr = 0.0
 
-                # Handle Lora Optimizers & Conditions
-                for optimizer_spatial in optimizer_spatial_list:
-                    optimizer_spatial.zero_grad(set_to_none=True)
-
-                if optimizer_temporal is not None:
-                    optimizer_temporal.zero_grad(set_to_none=True)
+                # Handle Lora Optimizers & Conditions, same as zero_grad(set_to_none=True) on every optimizer
+                for p in trainable_params:
+                    p.grad = None
     
                 mask_spatial_lora = random.uniform(0, 1) < 0.2
                 #mask_spatial_lora = 0
 
                 # Sample a random timestep for each video
-                timesteps = torch.randint(0, 1000, (1,), device=pixel_values.device)
+                timesteps = torch.randint(0, 1000, (1,), device=latents.device)
                 timesteps = timesteps.long()
 
                 # Add noise to the latents according to the noise magnitude at each timestep
                 # (this is the forward diffusion process)
                                     
-                noise = sample_noise(latents, 0, use_offset_noise=use_offset_noise)
+                noise = sample_noise(latents, 0.0, use_offset_noise=use_offset_noise)
                 comfy.model_management.soft_empty_cache()
                 target = noise
 
-                with torch.cuda.amp.autocast():
+                with torch.cuda.amp.autocast(dtype=autocast_dtype):
                     if mask_spatial_lora:
-                        loras = extract_lora_child_module(unet, target_replace_module=target_spatial_modules)
-                        scale_loras(loras, 0.)
+                        scale_loras(spatial_loras, 0.)
                         loss_spatial = None
                     else:
-                        loras = extract_lora_child_module(unet, target_replace_module=target_spatial_modules)
-                        scale_loras(loras, 1.0)
+                        scale_loras(spatial_loras, 1.0)
 
-                        loras = extract_lora_child_module(unet, target_replace_module=target_temporal_modules)
-                        if len(loras) > 0:
-                            scale_loras(loras, 0.)
-                        
+                        if len(temporal_loras) > 0:
+                            scale_loras(temporal_loras, 0.)
+                    
                         ### >>>> Spatial LoRA Prediction >>>> ###
-                        noisy_latents = train_noise_scheduler_spatial.add_noise(latents, noise, timesteps)
+                        noisy_latents = add_noise(alphas_cumprod_spatial, latents, noise, timesteps)
                         noisy_latents_input, target_spatial = get_spatial_latents(
                             pixel_values,  
                             noisy_latents,
                             target,
                         )
-                        model_pred_spatial = unet(noisy_latents_input.unsqueeze(2), timesteps,
+                        model_pred_spatial = train_unet(noisy_latents_input.unsqueeze(2), timesteps,
                                                 encoder_hidden_states=encoder_hidden_states).sample
                         loss_spatial = F.mse_loss(model_pred_spatial[:, :, 0, :, :].float(),
                                                 target_spatial.float(), reduction="mean")
-                        
-                    loras = extract_lora_child_module(unet, target_replace_module=target_temporal_modules)
-                    scale_loras(loras, 1.0)
                     
+                    scale_loras(temporal_loras, 1.0)
+                
                     ### >>>> Temporal LoRA Prediction >>>> ###
-                    noisy_latents = train_noise_scheduler.add_noise(latents, noise, timesteps)
-                    model_pred = unet(noisy_latents, timesteps, encoder_hidden_states=encoder_hidden_states).sample
-                    
+                    noisy_latents = add_noise(alphas_cumprod, latents, noise, timesteps)
+                    model_pred = train_unet(noisy_latents, timesteps, encoder_hidden_states=encoder_hidden_states).sample
+                
                     loss_temporal = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
                     loss_temporal = create_ad_temporal_loss(model_pred, loss_temporal, target)
-                        
+                    
                     # Backpropagate
+                    # The spatial and temporal forwards build separate graphs, so the spatial graph can be freed
+                    # right away. The spatial optimizer has already stepped by the time the temporal loss is
+                    # backpropagated, so only the temporal LoRAs need gradients from it.
                     if not mask_spatial_lora:
-                        scaler.scale(loss_spatial).backward(retain_graph=True)
+                        scaler.scale(loss_spatial).backward()
                         scaler.step(optimizer_spatial_list[0])
-                                        
-                    scaler.scale(loss_temporal).backward()
+                                    
+                    scaler.scale(loss_temporal).backward(inputs=temporal_params)
                     scaler.step(optimizer_temporal)
-        
+    
                     lr_scheduler_spatial_list[0].step()
                     spatial_scheduler_lr = lr_scheduler_spatial_list[0].get_lr()[0]
                         
@@ -1203,18 +1333,19 @@ class ADMD_TrainLora:
                 progress_bar.update(1)
                 pbar.update(1)
                 global_step += 1
+                # Copy both losses to the cpu together so logging only syncs with the device once
+                losses = torch.stack([
+                    loss_temporal.detach(),
+                    loss_spatial.detach() if loss_spatial is not None else torch.zeros_like(loss_temporal)
+                ]).cpu().tolist()
                 logs = {
-                    "Temporal Loss": loss_temporal.detach().item(),
+                    "Temporal Loss": losses[0],
                     "Temporal LR": temporal_scheduler_lr, 
-                    "Spatial Loss": loss_spatial.detach().item() if loss_spatial is not None else 0,
+                    "Spatial Loss": losses[1],
                     "Spatial LR": spatial_scheduler_lr
                 }
                 progress_bar.set_postfix(**logs)
 
-                # if global_step >= steps:
-                #     print("BREAK")
-                #     break
-
             admd_pipeline.update({
                 "global_step": global_step,
                 "unet": unet,
@@ -1265,41 +1396,42 @@ class ADMD_ValidationSampler:
             validation_spatial_scale = validation_settings["spatial_scale"]
             validation_seed = validation_settings["seed"]
             validation_prompt = validation_settings["validation_prompt"]
+            prompt_separator = validation_settings.get("prompt_separator", "")
                       
             with torch.inference_mode(True):
-                samples = []
-                generator = torch.Generator(device=device)
+                # The generator is kept between validations and reseeded each time
+                generator = getattr(self, "generator", None)
+                if generator is None or generator.device != device:
+                    generator = self.generator = torch.Generator(device=device)
                 generator.manual_seed(validation_seed)
                 
-                with torch.cuda.amp.autocast(enabled=True):
-                    unet.disable_gradient_checkpointing()
-                    unet.eval()
-                    loras = extract_lora_child_module(
-                        unet, 
-                        target_replace_module=["Transformer3DModel"]
-                    )
-                    scale_loras(loras, validation_spatial_scale)
-                    
-                    with torch.inference_mode(True):
-                        if len(validation_prompt) == 0:
-                            prompt = text_prompt
-                        else: 
-                            prompt = validation_prompt
-                        
-                        sample = validation_pipeline(
-                            prompt,
-                            generator    = generator,
-                            video_length = B,
-                            height       = H,
-                            width        = W,
-                            num_inference_steps = validation_inference_steps,
-                            guidance_scale = validation_guidance_scale,
-                        ).videos
-                        samples.append(sample)
-                # Reshape the sample tensor for returning
-                samples = torch.concat(samples)
-                samples = samples.view(*samples.shape[1:])
-                samples = samples.permute(1, 2, 3, 0).cpu() 
+                # Checkpointing is only used by the blocks in training mode, so eval() is enough to skip it
+                unet.eval()
+                scale_loras(admd_pipeline["transformer_loras"], validation_spatial_scale)
+
+                # The validation prompt is a single prompt unless a separator is set, then each non-empty part
+                # is its own prompt and all of them are sampled in one batched call
+                if prompt_separator:
+                    prompts = [p.strip() for p in validation_prompt.split(prompt_separator) if p.strip()]
+                else:
+                    prompts = [validation_prompt] if len(validation_prompt) > 0 else []
+                if len(prompts) == 0:
+                    prompts = list(text_prompt)
+
+                # Only the sampling itself runs under autocast. The unet isn't compiled here: eval, inference mode,
+                # the guidance batch and each spatial scale would all recompile the graph shared with training
+                with torch.amp.autocast(device_type="cuda", dtype=get_autocast_dtype()):
+                    sample = validation_pipeline(
+                        prompts,
+                        generator    = generator,
+                        video_length = B,
+                        height       = H,
+                        width        = W,
+                        num_inference_steps = validation_inference_steps,
+                        guidance_scale = validation_guidance_scale,
+                    ).videos
+                # Reshape the sample tensor for returning, the videos are returned one after another: (B, C, F, H, W) -> (B*F, H, W, C)
+                samples = sample.permute(0, 2, 3, 4, 1).reshape(-1, H, W, C).cpu()
                 return (admd_pipeline, samples,)
             
 class ADMD_MakeBatchList: